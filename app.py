@@ -3,17 +3,33 @@ CrowdGuardian Sentinel - Flask API Backend
 Serves the YOLOv8 crowd analysis model via REST endpoints.
 """
 
-import csv
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+import functools
+import hashlib
 import random
-from io import StringIO
+import threading
+import time
 import urllib.request
 from flask import Flask, request, jsonify, send_from_directory, Response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
 from model import analyze_image, analyze_video_frame
 import os
 
+class OrjsonProvider(JSONProvider):
+    """Serializes jsonify() responses with orjson instead of the stdlib encoder"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__, static_folder='.', static_url_path='')
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Serve frontend
@@ -25,6 +41,22 @@ def index():
 def static_files(path):
     return send_from_directory('.', path)
 
+# Alerts are sent off the request path and coalesced so bursts don't spam ntfy
+ALERT_COOLDOWN_S = 30
+_alert_pool = ThreadPoolExecutor(max_workers=2)
+_alert_lock = threading.Lock()
+_last_alert_at = 0.0
+
+def queue_ntfy_alert(people_count):
+    """Schedules trigger_ntfy_alert in the background, at most once per cooldown window"""
+    global _last_alert_at
+    with _alert_lock:
+        now = time.monotonic()
+        if now - _last_alert_at < ALERT_COOLDOWN_S:
+            return
+        _last_alert_at = now
+    _alert_pool.submit(trigger_ntfy_alert, people_count)
+
 def trigger_ntfy_alert(people_count):
     """Sends a free push notification to mobile via ntfy.sh"""
     topic = "crowdguardian_cit_hack"
@@ -44,6 +76,25 @@ def trigger_ntfy_alert(people_count):
     except Exception as e:
         print(f">> Failed to send mobile alert: {e}")
 
+# Recent analysis results keyed by upload hash, so re-submitted files skip the model entirely
+ANALYSIS_CACHE_SIZE = 64
+_analysis_cache = OrderedDict()
+_analysis_cache_lock = threading.Lock()
+
+def get_cached_analysis(key):
+    with _analysis_cache_lock:
+        result = _analysis_cache.get(key)
+        if result is not None:
+            _analysis_cache.move_to_end(key)
+        return result
+
+def cache_analysis(key, result):
+    with _analysis_cache_lock:
+        _analysis_cache[key] = result
+        _analysis_cache.move_to_end(key)
+        if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
+
 # API endpoint for crowd analysis
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
@@ -57,36 +108,44 @@ def analyze():
     file_bytes = file.read()
     filename = file.filename.lower()
     
+    # blake2b is much faster than SHA-256 on multi-MB uploads; collision resistance is plenty here
+    cache_key = hashlib.blake2b(file_bytes, digest_size=16).digest()
+    
     try:
-        if filename.endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm')):
-            result = analyze_video_frame(file_bytes)
-        else:
-            result = analyze_image(file_bytes)
+        result = get_cached_analysis(cache_key)
+        if result is None:
+            if filename.endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm')):
+                result = analyze_video_frame(file_bytes)
+            else:
+                result = analyze_image(file_bytes)
+            
+            if 'error' not in result:
+                cache_analysis(cache_key, result)
             
         # Check if risk is high and send mobile notification
+        # (cached results too; the alert cooldown decides what actually gets sent)
         if result.get('density_level') == 'HIGH':
-            trigger_ntfy_alert(result.get('people_count'))
+            queue_ntfy_alert(result.get('people_count'))
         
         return jsonify(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# API endpoint for Analytics
-@app.route('/api/analytics', methods=['GET'])
-def get_analytics():
+# Mock analytics/report payloads only change per day, so build them once and reuse
+@functools.lru_cache(maxsize=1)
+def build_analytics(day):
     # Mocking historical analytics data for a bar/line chart
     days = []
     total_people = []
     avg_density = []
     
-    now = datetime.now()
     for i in range(7):
-        date = now - timedelta(days=6-i)
-        days.append(date.strftime('%A'))
+        d = day - timedelta(days=6-i)
+        days.append(d.strftime('%A'))
         total_people.append(random.randint(8000, 15000))
         avg_density.append(round(random.uniform(0.1, 0.4), 2))
         
-    return jsonify({
+    return {
         "labels": days,
         "datasets": {
             "total_people": total_people,
@@ -98,42 +157,45 @@ def get_analytics():
             {"name": "Concert Hall", "current_count": random.randint(100, 300), "status": "Normal"},
             {"name": "VIP Lounge", "current_count": random.randint(10, 50), "status": "Quiet"}
         ]
-    })
+    }
 
-# API endpoint for Reports Download
-@app.route('/api/reports/download', methods=['GET'])
-def download_report():
-    # Generate a mock CSV report
-    si = StringIO()
-    cw = csv.writer(si)
-    cw.writerow(["Date", "Time", "Zone", "People Count", "Density Level", "Alerts Generated"])
-    
-    now = datetime.now()
+@functools.lru_cache(maxsize=1)
+def build_report_csv(day):
+    # Generate a mock CSV report for the 24 hours leading up to the start of `day`
+    end = datetime.combine(day, datetime.min.time())
     zones = ["Main Entrance", "Food Court", "Concert Hall", "VIP Lounge"]
     
+    def row(record_time, zone):
+        count = random.randint(10, 500)
+        density = "LOW" if count < 100 else ("MODERATE" if count < 300 else "HIGH")
+        alerts = random.randint(0, 2) if density == "HIGH" else 0
+        return f"{record_time:%Y-%m-%d},{record_time:%H:00},{zone},{count},{density},{alerts}"
+    
     # Generate random data for the past 24 hours
-    for i in range(24):
-        record_time = now - timedelta(hours=24-i)
-        for zone in zones:
-            count = random.randint(10, 500)
-            density = "LOW" if count < 100 else ("MODERATE" if count < 300 else "HIGH")
-            alerts = random.randint(0, 2) if density == "HIGH" else 0
-            cw.writerow([
-                record_time.strftime("%Y-%m-%d"),
-                record_time.strftime("%H:00"),
-                zone,
-                count,
-                density,
-                alerts
-            ])
-            
-    output = si.getvalue()
+    rows = [
+        row(end - timedelta(hours=24-i), zone)
+        for i in range(24)
+        for zone in zones
+    ]
+    header = "Date,Time,Zone,People Count,Density Level,Alerts Generated"
+    return "\n".join([header, *rows]) + "\n"
+
+# API endpoint for Analytics
+@app.route('/api/analytics', methods=['GET'])
+def get_analytics():
+    return jsonify(build_analytics(date.today()))
+
+# API endpoint for Reports Download
+@app.route('/api/reports/download', methods=['GET'])
+def download_report():
+    today = date.today()
     return Response(
-        output,
+        build_report_csv(today),
         mimetype="text/csv",
-        headers={"Content-Disposition": f"attachment;filename=crowd_report_{now.strftime('%Y%m%d')}.csv"}
+        headers={"Content-Disposition": f"attachment;filename=crowd_report_{today.strftime('%Y%m%d')}.csv"}
     )
 
+# Local development only; in production run `gunicorn app:app` (see gunicorn.conf.py)
 if __name__ == '__main__':
 
     print("=" * 50)
@@ -0,0 +1,50 @@
+"""
+CrowdGuardian Sentinel - TensorRT Engine Builder
+Exports the YOLOv8 weights to a cached TensorRT FP16 engine.
+Run before serving (gunicorn does this in on_starting): python engine.py
+"""
+
+import os
+import torch
+from ultralytics import YOLO
+
+MODEL_WEIGHTS = "yolov8m.pt"
+IMGSZ = 640
+
+# Largest batch the engine accepts; the batching queue in model.py never exceeds it
+BATCH_MAX_SIZE = 8
+
+
+def engine_path():
+    """TensorRT engines are tied to the GPU architecture and TensorRT release, so cache one per pair."""
+    import tensorrt
+    major, minor = torch.cuda.get_device_capability()
+    return f"yolov8m_sm{major}{minor}_trt{tensorrt.__version__}.engine"
+
+
+def ensure_engine():
+    """
+    Export the TensorRT engine if CUDA is present and it isn't cached yet.
+    
+    Returns:
+        Path of the cached engine, or None on CPU-only hosts.
+        Raises if TensorRT is missing or the export fails.
+    """
+    if not torch.cuda.is_available():
+        return None
+    
+    engine = engine_path()
+    if not os.path.exists(engine):
+        exported = YOLO(MODEL_WEIGHTS).export(
+            format="engine", imgsz=IMGSZ, half=True, dynamic=True, batch=BATCH_MAX_SIZE, workspace=4
+        )
+        os.replace(exported, engine)
+    return engine
+
+
+if __name__ == '__main__':
+    try:
+        print(f">> TensorRT engine ready: {ensure_engine() or 'skipped (no CUDA)'}")
+    except Exception as e:
+        # Not fatal: model.load_model falls back to the PyTorch weights
+        print(f">> TensorRT engine unavailable, using PyTorch weights: {e}")
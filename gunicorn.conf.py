@@ -0,0 +1,32 @@
+"""
+CrowdGuardian Sentinel - Production server config
+Run with: gunicorn app:app
+"""
+
+import os
+import subprocess
+import sys
+
+bind = "0.0.0.0:5000"
+
+# One process owns the GPU model and its batching queue; request threads feed it.
+# Each extra worker loads its own copy of the model.
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = "gthread"
+threads = 8
+
+# Covers loading the cached engine/weights and the warm-up inference in each worker
+timeout = 120
+
+
+def on_starting(server):
+    """
+    Build and cache the TensorRT engine before any worker starts.
+    
+    The export can take longer than any sane worker timeout, so it runs here in
+    a separate process (keeping CUDA out of the arbiter) instead of during the
+    workers' app import. It only does work when CUDA is present and no engine
+    is cached yet; workers then just load the cached engine.
+    """
+    server.log.info("Checking TensorRT engine (the first run exports it)...")
+    subprocess.run([sys.executable, "engine.py"], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)